@@ -3,8 +3,117 @@
 # Put this file and sora_api.py into ComfyUI's custom nodes directory and restart ComfyUI.
 
 from typing import Tuple, Optional
-import json, os, time, base64
-from sora_api import SoraAPIClient, save_bytes_to_tempfile, is_done_status
+import os, re, time, random
+from tempfile import SpooledTemporaryFile
+from sora_api import get_client, save_bytes_to_tempfile, is_done_status, parse_retry_after, json_loads
+
+# pybase64 为可选依赖（SIMD 解码），未安装时退回标准库
+try:
+    from pybase64 import b64decode as _b64decode
+except ImportError:
+    from base64 import b64decode as _b64decode
+
+# 轮询退避的最大间隔（秒）
+POLL_MAX_INTERVAL = 30
+
+# 下载结果检测：字段名按优先级排列
+_URL_KEYS = ("video_url", "url", "download_url", "video")
+_B64_KEYS = ("video_base64", "video_b64", "b64")
+_URL_RE = re.compile(r"^https?://").match
+# base64 字符查表：合法字符映射为 1，其余为 0
+_B64_OK = bytes(1 if chr(i) in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\r\n" else 0
+                for i in range(256))
+
+
+def _iter_strings(j):
+    """
+    Single pass over the containers the API puts results in, yielding
+    (depth, key_lower, value) for every str field: the top level (depth 0),
+    then each outputs[*] item and result (depth 1). Other nested objects
+    (thumbnail, input_reference, error docs, ...) are not searched.
+    """
+    if not isinstance(j, dict):
+        return
+    nested = []
+    for k, v in j.items():
+        if isinstance(v, str):
+            yield 0, str(k).lower(), v
+    outputs = j.get("outputs")
+    if isinstance(outputs, list):
+        nested.extend(x for x in outputs if isinstance(x, dict))
+    if isinstance(j.get("result"), dict):
+        nested.append(j["result"])
+    for d in nested:
+        for k, v in d.items():
+            if isinstance(v, str):
+                yield 1, str(k).lower(), v
+
+
+def _looks_b64(v: str) -> bool:
+    """
+    Cheap alphabet check before handing a string to the decoder, so that
+    non-base64 values never go through the decoder's exception path.
+    """
+    if len(v) <= 100 or not v.isascii():
+        return False
+    return b"\x00" not in v.encode("ascii").translate(_B64_OK)
+
+# base64 分块解码：每块字符数（4 的倍数），超过 max_size 的数据落盘
+_B64_CHUNK = 4 << 20
+_SPOOL_MAX_SIZE = 8 << 20
+
+
+def _b64_to_spooled(b64_str: str, start: int = 0) -> SpooledTemporaryFile:
+    """
+    Decode b64_str[start:] in ~4 MiB slices straight into a SpooledTemporaryFile,
+    so the full decoded payload never sits in memory next to the source string.
+    Whitespace inside the data is tolerated by carrying unaligned tails over.
+    Returned file is positioned at 0; caller closes it.
+    """
+    spool = SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+    try:
+        carry = ""
+        for i in range(start, len(b64_str), _B64_CHUNK):
+            chunk = carry + "".join(b64_str[i:i + _B64_CHUNK].split())
+            cut = len(chunk) - len(chunk) % 4
+            carry = chunk[cut:]
+            if cut:
+                spool.write(_b64decode(chunk[:cut], validate=False))
+        if carry:
+            spool.write(_b64decode(carry, validate=False))
+        spool.seek(0)
+        return spool
+    except BaseException:
+        spool.close()
+        raise
+
+
+def _download_candidates(j, field: str):
+    """
+    Single pass over the response JSON; returns [(is_url, value)] ordered as:
+    the download_field match, then URL fields, then base64 fields.
+    Every non-URL entry has already passed _looks_b64.
+    """
+    preferred, urls, b64s = [], [], []
+    for depth, k, v in _iter_strings(j):
+        if field and k == field:
+            preferred.append(v)
+        elif k in _URL_KEYS and _URL_RE(v):
+            urls.append((depth, _URL_KEYS.index(k), v))
+        elif k in _B64_KEYS and _looks_b64(v):
+            b64s.append((depth, _B64_KEYS.index(k), v))
+
+    # sort 是稳定的：同深度同字段时保持遍历顺序（outputs 在 result 之前）
+    candidates = []
+    for v in preferred:
+        if _URL_RE(v):
+            candidates.append((True, v))
+        elif _looks_b64(v):
+            candidates.append((False, v))
+    candidates += [(True, v) for _, _, v in sorted(urls, key=lambda c: c[:2])]
+    candidates += [(False, v) for _, _, v in sorted(b64s, key=lambda c: c[:2])]
+    return candidates
+
 
 class CreateVideoJob:
     @classmethod
@@ -48,33 +157,42 @@ class CreateVideoJob:
         extra = {}
         if extra_fields_json:
             try:
-                extra = json.loads(extra_fields_json)
+                extra = json_loads(extra_fields_json)
             except Exception as e:
                 return ({"ok": False, "error": f"extra_fields_json parse error: {e}"}, "")
 
-        client = SoraAPIClient(base_url=base_url, api_key=api_key or None, timeout=timeout)
+        client = get_client(base_url, api_key or None, timeout)
 
-        image_bytes = None
+        image_file = None
         if image_base64:
-            b64 = image_base64
-            if b64.startswith("data:"):
-                try:
-                    b64 = b64.split(",", 1)[1]
-                except Exception:
-                    pass
+            # data URL 头部很短：只在前 256 个字符内找逗号，按偏移解码，避免复制整段数据
+            start = 0
+            if image_base64.startswith("data:"):
+                comma = image_base64.find(",", 0, 256)
+                if comma > 0:
+                    start = comma + 1
             try:
-                image_bytes = base64.b64decode(b64)
+                image_file = _b64_to_spooled(image_base64, start)
             except Exception as e:
                 return ({"ok": False, "error": f"image_base64 decode error: {e}"}, "")
+            if image_file.seek(0, os.SEEK_END) == 0:
+                image_file.close()
+                image_file = None
+            else:
+                image_file.seek(0)
 
-        resp = client.create_video_job(endpoint=endpoint,
-                                       image_path=file_path if (not image_bytes and file_path) else None,
-                                       image_bytes=image_bytes,
-                                       filename=filename,
-                                       prompt=prompt,
-                                       model=model,
-                                       trim=trim,
-                                       extra_fields=extra)
+        try:
+            resp = client.create_video_job(endpoint=endpoint,
+                                           image_path=file_path if (image_file is None and file_path) else None,
+                                           image_bytes=image_file,
+                                           filename=filename,
+                                           prompt=prompt,
+                                           model=model,
+                                           trim=trim,
+                                           extra_fields=extra)
+        finally:
+            if image_file is not None:
+                image_file.close()
 
         job_id = ""
         j = resp.get("json") or {}
@@ -101,6 +219,7 @@ class GetVideoJobStatus:
                 "poll": ("BOOLEAN", {"default": False}),  # 是否轮询直到完成
                 "poll_interval": ("INT", {"default": 3}), # 秒
                 "poll_timeout": ("INT", {"default": 120}), # 秒，轮询总超时
+                "poll_max_attempts": ("INT", {"default": 60}), # 最大请求次数
                 "timeout": ("INT", {"default": 30})
             }
         }
@@ -117,14 +236,17 @@ class GetVideoJobStatus:
              poll: bool = False,
              poll_interval: int = 3,
              poll_timeout: int = 120,
+             poll_max_attempts: int = 60,
              timeout: int = 30
              ) -> Tuple[Optional[dict], Optional[str]]:
 
-        client = SoraAPIClient(base_url=base_url, api_key=api_key or None, timeout=timeout)
+        client = get_client(base_url, api_key or None, timeout)
 
         start = time.time()
+        attempt = 0
         while True:
             resp = client.get_job(endpoint=endpoint, job_id=job_id)
+            attempt += 1
             j = resp.get("json") or {}
             status = None
             # common status keys
@@ -139,13 +261,32 @@ class GetVideoJobStatus:
                 if is_done_status(status):
                     return (resp, status)
                 elapsed = time.time() - start
-                if elapsed >= poll_timeout:
+                if elapsed >= poll_timeout or attempt >= poll_max_attempts:
                     return (resp, status)
-                time.sleep(max(0.5, poll_interval))
+                time.sleep(min(self._next_delay(resp, j, attempt, poll_interval), poll_timeout - elapsed))
                 continue
             else:
                 return (resp, status)
 
+    @staticmethod
+    def _next_delay(resp: dict, j: dict, attempt: int, poll_interval: int) -> float:
+        # 服务端给出 Retry-After 时优先使用（含 503 响应；resp["headers"] 是普通 dict，按小写匹配）
+        headers = resp.get("headers") or {}
+        retry_after = parse_retry_after(next((v for k, v in headers.items() if k.lower() == "retry-after"), None))
+        if retry_after is not None:
+            return retry_after
+        # 首次轮询：服务端给出预计完成时间时直接等到该时间
+        if attempt == 1:
+            eta = j.get("eta_seconds")
+            if isinstance(eta, (int, float)) and eta > 0:
+                return float(eta)
+            eta = j.get("estimated_completion")
+            if isinstance(eta, (int, float)) and eta > time.time():
+                return eta - time.time()
+        # 指数退避 + 抖动
+        base = max(0.5, poll_interval)
+        return min(base * (2 ** (attempt - 1)), POLL_MAX_INTERVAL) + random.uniform(0, 0.5)
+
 
 class DownloadVideoResult:
     @classmethod
@@ -159,7 +300,9 @@ class DownloadVideoResult:
             },
             "optional": {
                 "download_field": ("STRING", {"default": ""}),  # 指定包含下载地址或 base64 的字段名，留空自动检测
-                "timeout": ("INT", {"default": 30})
+                "timeout": ("INT", {"default": 30}),
+                "prefetched_resp": ("JSON", {}),  # 连接 GetVideoJobStatus 的 resp_dict，可省去一次查询
+                "save_dir": ("STRING", {"default": ""}),  # 视频保存目录，留空使用系统临时目录
             }
         }
 
@@ -173,92 +316,50 @@ class DownloadVideoResult:
              api_key: str,
              job_id: str,
              download_field: str = "",
-             timeout: int = 30
+             timeout: int = 30,
+             prefetched_resp: Optional[dict] = None,
+             save_dir: str = ""
              ) -> Tuple[Optional[dict], Optional[str]]:
 
-        client = SoraAPIClient(base_url=base_url, api_key=api_key or None, timeout=timeout)
-        resp = client.get_job(endpoint=endpoint, job_id=job_id)
-        j = resp.get("json") or {}
+        client = get_client(base_url, api_key or None, timeout)
+        field = download_field.strip().lower()
+        # 直接写入目标目录，避免下载后再复制
+        save_dir = save_dir or None
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
         saved_path = ""
 
-        # 指定字段优先
-        if download_field:
-            v = j.get(download_field)
-            if isinstance(v, str) and v.startswith("http"):
-                dl = client.download_url(v)
-                if dl.get("ok"):
-                    try:
-                        saved_path = save_bytes_to_tempfile(dl.get("raw") or b"", suffix=".mp4")
-                        return (resp, saved_path)
-                    except Exception:
-                        return (resp, "")
-            if isinstance(v, str) and len(v) > 100:
-                try:
-                    b = base64.b64decode(v)
-                    saved_path = save_bytes_to_tempfile(b, suffix=".mp4")
-                    return (resp, saved_path)
-                except Exception:
-                    pass
+        # 复用上游 GetVideoJobStatus 的响应，缺少下载字段时才重新请求
+        resp = prefetched_resp if isinstance(prefetched_resp, dict) else None
+        candidates = _download_candidates(resp.get("json") or {}, field) if resp else []
+        if not candidates:
+            # 流式请求：若接口直接返回视频，按响应头判断后直接写盘，不做 JSON 解析
+            resp = client.download_job(endpoint=endpoint, job_id=job_id, suffix=".mp4", dir=save_dir)
+            if resp.get("path"):
+                return (resp, resp["path"])
+            candidates = _download_candidates(resp.get("json") or {}, field)
 
-        # 常用字段检测
-        for k in ("video_url", "url", "download_url", "video"):
-            v = j.get(k)
-            if isinstance(v, str) and v.startswith("http"):
-                try:
-                    dl = client.download_url(v)
-                    if dl.get("ok"):
-                        saved_path = save_bytes_to_tempfile(dl.get("raw") or b"", suffix=".mp4")
-                        return (resp, saved_path)
-                except Exception:
-                    pass
+        # 多个下载地址时并行 HEAD 探测：仍按字段优先级选择，只跳过不可用的地址
+        urls = [v for is_url, v in candidates if is_url]
+        best, head = None, None
+        if len(urls) > 1:
+            best, head = client.pick_reachable_url(urls)
+            first = next(i for i, (is_url, _) in enumerate(candidates) if is_url)
+            candidates.remove((True, best))
+            candidates.insert(first, (True, best))
 
-        for k in ("video_base64", "video_b64", "b64"):
-            v = j.get(k)
-            if isinstance(v, str) and len(v) > 100:
+        for is_url, v in candidates:
+            if is_url:
+                dl = client.download_to_file(v, suffix=".mp4", dir=save_dir, head=head if v == best else None)
+                if dl.get("ok"):
+                    return (resp, dl["path"])
+            else:
                 try:
-                    b = base64.b64decode(v)
-                    saved_path = save_bytes_to_tempfile(b, suffix=".mp4")
+                    saved_path = save_bytes_to_tempfile(_b64decode(v, validate=False), suffix=".mp4", dir=save_dir)
                     return (resp, saved_path)
                 except Exception:
                     pass
 
-        # nested outputs
-        if isinstance(j.get("outputs"), list) and len(j["outputs"]) > 0:
-            first = j["outputs"][0]
-            if isinstance(first, dict):
-                for k in ("url", "download_url", "video_url"):
-                    v = first.get(k)
-                    if isinstance(v, str) and v.startswith("http"):
-                        try:
-                            dl = client.download_url(v)
-                            if dl.get("ok"):
-                                saved_path = save_bytes_to_tempfile(dl.get("raw") or b"", suffix=".mp4")
-                                return (resp, saved_path)
-                        except Exception:
-                            pass
-
-        if isinstance(j.get("result"), dict):
-            for k in ("url", "video_url", "download_url"):
-                v = j["result"].get(k)
-                if isinstance(v, str) and v.startswith("http"):
-                    try:
-                        dl = client.download_url(v)
-                        if dl.get("ok"):
-                            saved_path = save_bytes_to_tempfile(dl.get("raw") or b"", suffix=".mp4")
-                            return (resp, saved_path)
-                    except Exception:
-                        pass
-
-        # raw response check
-        ct = resp.get("headers", {}).get("Content-Type", "")
-        raw = resp.get("raw")
-        if raw and isinstance(ct, str) and ct.startswith("video"):
-            try:
-                saved_path = save_bytes_to_tempfile(raw, suffix=".mp4")
-                return (resp, saved_path)
-            except Exception:
-                pass
-
         return (resp, saved_path)
 
 
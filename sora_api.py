@@ -1,39 +1,106 @@
 # sora_api.py
 # SORA / DyuAPI API client (multipart upload, job query, download)
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import mimetypes
 import tempfile
 import os
 import base64
 import time
-from typing import Optional, Dict, Any, Union
+import functools
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Union, BinaryIO, Tuple, Iterable, List
 
-def save_bytes_to_tempfile(bytes_data: bytes, suffix: str = ".mp4") -> str:
-    fd, path = tempfile.mkstemp(suffix=suffix, prefix="sora_video_")
+# orjson 为可选依赖（更快的 JSON 解析），未安装时退回标准库；两者都接受 bytes/str
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# requests-toolbelt 为可选依赖：可用时以流式 multipart 上传，否则退回 requests 的 files=
+try:
+    from requests_toolbelt import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
+
+# 大于该大小且服务端支持 Range 时分段并行下载
+RANGE_MIN_SIZE = 16 << 20
+RANGE_PARTS = 4
+RANGE_RETRIES = 3
+
+# 每个客户端最多缓存的 job ETag 数
+ETAG_CACHE_SIZE = 64
+
+_DONE_STATES = frozenset(("succeeded", "completed", "finished", "done", "success"))
+
+class _RangeNotSupported(Exception):
+    pass
+
+def save_bytes_to_tempfile(bytes_data: Union[bytes, Iterable[bytes]], suffix: str = ".mp4",
+                           dir: Optional[str] = None) -> str:
+    """
+    Write bytes (or an iterable of byte chunks, e.g. iter_content) to a new tempfile
+    through the descriptor returned by mkstemp. Returns the file path.
+    dir places the file directly in its final directory (default: system temp dir).
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix="sora_video_", dir=dir)
     try:
-        os.close(fd)
-        with open(path, "wb") as f:
-            f.write(bytes_data)
+        with os.fdopen(fd, "wb", buffering=1 << 20) as f:
+            if isinstance(bytes_data, (bytes, bytearray, memoryview)):
+                f.write(bytes_data)
+            else:
+                for chunk in bytes_data:
+                    f.write(chunk)
         return path
-    except Exception:
+    except BaseException:
         try:
             os.remove(path)
-        except Exception:
+        except OSError:
             pass
         raise
 
 def is_done_status(status: Optional[str]) -> bool:
-    if not status:
-        return False
-    s = str(status).strip().lower()
-    done_states = {"succeeded", "completed", "finished", "done", "success"}
-    return s in done_states
+    return bool(status) and str(status).strip().lower() in _DONE_STATES
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header (delta-seconds or HTTP-date) into seconds to wait.
+    Returns None if missing or unparseable.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
 
 class SoraAPIClient:
     def __init__(self, base_url: str, api_key: Optional[str] = None, timeout: int = 60):
         self.base_url = base_url.rstrip("/")
         self.api_key = api_key
         self.timeout = timeout
+        # 复用 TCP/TLS 连接：轮询与下载共用同一个连接池
+        # 重试耗尽后返回最后的响应而不是抛出 RetryError，且不在此处等待 Retry-After，
+        # 由调用方（如轮询循环）根据响应头自行决定等待时间
+        self.session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                      respect_retry_after_header=False, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self._headers())
+        # 条件轮询缓存：job URL -> (ETag, 上次的响应)
+        self._last_etag: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+
+    def close(self) -> None:
+        self.session.close()
 
     def _headers(self) -> Dict[str, str]:
         headers = {}
@@ -44,7 +111,7 @@ class SoraAPIClient:
     def create_video_job(self,
                          endpoint: str,
                          image_path: Optional[str] = None,
-                         image_bytes: Optional[bytes] = None,
+                         image_bytes: Optional[Union[bytes, BinaryIO]] = None,
                          filename: Optional[str] = None,
                          prompt: Optional[str] = None,
                          model: Optional[str] = None,
@@ -54,27 +121,14 @@ class SoraAPIClient:
         """
         Submit a create-video job (multipart/form-data).
         Uses file field name 'input_reference' as in the API sample.
+        image_bytes may be raw bytes or a readable binary file object.
         Returns dict: {status_code, ok, headers, text, json, raw}
         """
         url = f"{self.base_url}/{endpoint.lstrip('/')}"
-        headers = self._headers()
 
         files = {}
         data = {}
 
-        # 文件部分 (field name: input_reference)
-        if image_bytes is not None:
-            fname = filename or "input.png"
-            ctype = mimetypes.guess_type(fname)[0] or "application/octet-stream"
-            # requests accepts bytes via (filename, bytes, content_type)
-            files["input_reference"] = (fname, image_bytes, ctype)
-        elif image_path:
-            if not os.path.exists(image_path):
-                return {"status_code": None, "ok": False, "error": f"file not found: {image_path}"}
-            fname = os.path.basename(image_path)
-            ctype = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
-            files["input_reference"] = (fname, open(image_path, "rb"), ctype)
-
         # 文本字段
         if prompt is not None:
             data["prompt"] = str(prompt)
@@ -86,70 +140,288 @@ class SoraAPIClient:
             for k, v in extra_fields.items():
                 data[str(k)] = str(v)
 
+        # 文件部分 (field name: input_reference)
+        fname = ctype = None
+        source = nullcontext(None)
+        if image_bytes is not None:
+            fname = filename or "input.png"
+            ctype = mimetypes.guess_type(fname)[0] or "application/octet-stream"
+            # requests accepts bytes or a file object via (filename, data, content_type)
+            source = nullcontext(image_bytes)
+        elif image_path:
+            if not os.path.exists(image_path):
+                return {"status_code": None, "ok": False, "error": f"file not found: {image_path}"}
+            fname = os.path.basename(image_path)
+            ctype = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+            source = open(image_path, "rb")
+
         try:
-            resp = requests.post(url, headers=headers, files=files if files else None, data=data if data else None, timeout=self.timeout)
+            # 仅关闭本方法打开的文件；调用方传入的文件对象由调用方关闭
+            with source as fh:
+                if fh is not None and MultipartEncoder is not None:
+                    # 流式编码：文件按块读取并发送，不在内存中拼装整个请求体
+                    m = MultipartEncoder(fields={**data, "input_reference": (fname, fh, ctype)})
+                    resp = self.session.post(url, data=m, headers={"Content-Type": m.content_type}, timeout=self.timeout)
+                else:
+                    if fh is not None:
+                        files["input_reference"] = (fname, fh, ctype)
+                    resp = self.session.post(url, files=files if files else None, data=data if data else None, timeout=self.timeout)
         except requests.RequestException as e:
-            # close opened file handle if any
-            if files.get("input_reference") and hasattr(files["input_reference"][1], "close"):
-                try:
-                    files["input_reference"][1].close()
-                except Exception:
-                    pass
             return {"status_code": None, "ok": False, "error": str(e), "json": None, "text": ""}
 
-        # close file handles
-        if files.get("input_reference") and hasattr(files["input_reference"][1], "close"):
-            try:
-                files["input_reference"][1].close()
-            except Exception:
-                pass
-
         return self._build_response(resp)
 
-    def get_job(self, endpoint: str, job_id: str) -> Dict[str, Any]:
+    def job_url(self, endpoint: str, job_id: str) -> str:
         """
-        GET job info. endpoint can be '/v1/videos/{id}' or '/v1/videos'
-        If endpoint contains '{id}', it will be replaced; otherwise GET {endpoint}/{id}
+        endpoint can be '/v1/videos/{id}' or '/v1/videos'
+        If endpoint contains '{id}', it will be replaced; otherwise {endpoint}/{id}
         """
         if "{id}" in endpoint:
-            url = f"{self.base_url}/{endpoint.lstrip('/')}".format(id=job_id)
-        else:
-            url = f"{self.base_url}/{endpoint.lstrip('/')}/{job_id}"
-        headers = self._headers()
+            return f"{self.base_url}/{endpoint.lstrip('/')}".format(id=job_id)
+        return f"{self.base_url}/{endpoint.lstrip('/')}/{job_id}"
+
+    def get_job(self, endpoint: str, job_id: str) -> Dict[str, Any]:
+        """
+        GET job info from job_url(endpoint, job_id).
+        Repeated polls send If-None-Match; a 304 returns the previous json/text with the
+        304's own status_code and headers, and not_modified=True.
+        """
+        url = self.job_url(endpoint, job_id)
+        cached = self._last_etag.get(url)
+        headers = {"If-None-Match": cached[0]} if cached else None
         try:
-            resp = requests.get(url, headers=headers, timeout=self.timeout)
+            resp = self.session.get(url, headers=headers, timeout=self.timeout)
         except requests.RequestException as e:
             return {"status_code": None, "ok": False, "error": str(e), "json": None, "text": ""}
 
-        return self._build_response(resp)
+        if resp.status_code == 304 and cached:
+            # 正文沿用上次的解析结果，状态码与响应头取本次 304 响应（避免沿用过期的 Retry-After 等）
+            result = dict(cached[1])
+            result.update(status_code=resp.status_code, ok=resp.ok, headers=dict(resp.headers), not_modified=True)
+            return result
+        result = self._build_response(resp)
+        etag = resp.headers.get("ETag")
+        if etag and resp.ok and result["json"] is not None:
+            self._last_etag.pop(url, None)
+            self._last_etag[url] = (etag, result)
+            if len(self._last_etag) > ETAG_CACHE_SIZE:
+                self._last_etag.pop(next(iter(self._last_etag)))
+        else:
+            self._last_etag.pop(url, None)
+        return result
+
+    def download_job(self, endpoint: str, job_id: str, suffix: str = ".mp4",
+                     dir: Optional[str] = None) -> Dict[str, Any]:
+        """
+        GET the job URL as a stream and decide from the response headers alone:
+        a video/* body is written straight to a tempfile (no text/JSON decoding),
+        anything else is read and built like get_job.
+        Returns dict: {status_code, ok, headers, text, json, raw, path}; path is None unless a video was saved.
+        """
+        url = self.job_url(endpoint, job_id)
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as r:
+                if r.ok and r.headers.get("Content-Type", "").startswith("video"):
+                    path = save_bytes_to_tempfile(r.iter_content(chunk_size=1 << 20), suffix=suffix, dir=dir)
+                    return {"status_code": r.status_code, "ok": True, "headers": dict(r.headers),
+                            "text": None, "json": None, "raw": None, "path": path}
+                result = self._build_response(r)
+        except (requests.RequestException, OSError) as e:
+            return {"status_code": None, "ok": False, "error": str(e), "json": None, "text": "", "path": None}
+        result["path"] = None
+        return result
 
     def download_url(self, url: str) -> Dict[str, Any]:
         """
         Download arbitrary URL and return wrapper containing raw bytes.
         """
-        headers = self._headers()
         try:
-            resp = requests.get(url, headers=headers, timeout=self.timeout)
+            resp = self.session.get(url, timeout=self.timeout)
         except requests.RequestException as e:
             return {"status_code": None, "ok": False, "error": str(e), "json": None, "text": "", "raw": None}
 
-        result = self._build_response(resp)
-        result["raw"] = resp.content
+        return self._build_response(resp, want_raw=True)
+
+    def download_to_file(self, url: str, suffix: str = ".mp4", parts: int = RANGE_PARTS,
+                         dir: Optional[str] = None, head: Optional[requests.Response] = None) -> Dict[str, Any]:
+        """
+        Stream URL straight into a tempfile without buffering the body in memory.
+        Large files on servers with Accept-Ranges are fetched as parallel byte ranges,
+        each resuming from its last written offset on connection errors.
+        The returned path is final (created under dir if given); no re-copy is needed.
+        head: an earlier HEAD response for url, reused instead of probing again.
+        Returns dict: {status_code, ok, headers, path}
+        """
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix="sora_video_", dir=dir)
+        try:
+            result = None
+            if parts > 1 and hasattr(os, "pwrite"):
+                size, headers = self._probe_range(url, head)
+                if size:
+                    result = self._download_ranges(url, fd, size, parts, headers)
+                    if result is not None:
+                        result["path"] = path
+            if result is None:
+                # 不支持 Range：回退到单连接流式下载
+                os.ftruncate(fd, 0)
+                os.lseek(fd, 0, os.SEEK_SET)
+                with self.session.get(url, stream=True, timeout=self.timeout) as r:
+                    if r.ok:
+                        for chunk in r.iter_content(chunk_size=1 << 20):
+                            os.write(fd, chunk)
+                    result = {"status_code": r.status_code, "ok": r.ok, "headers": dict(r.headers), "path": path}
+        except (requests.RequestException, OSError) as e:
+            result = {"status_code": None, "ok": False, "error": str(e), "path": None}
+        finally:
+            os.close(fd)
+        if not result["ok"]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            result["path"] = None
         return result
 
-    def _build_response(self, resp: requests.Response) -> Dict[str, Any]:
+    def pick_reachable_url(self, urls: List[str], probe_timeout: int = 5
+                           ) -> Tuple[Optional[str], Optional[requests.Response]]:
+        """
+        HEAD all candidate URLs (given in priority order) in parallel and return the
+        highest-priority one answering 2xx, together with its HEAD response so the
+        download can reuse it. The probe only skips dead or slow links: a lower-priority
+        URL is never chosen while a higher-priority probe is still pending.
+        Falls back to the first URL that rejects HEAD (405), then to urls[0].
+        """
+        if len(urls) <= 1:
+            return (urls[0] if urls else None), None
+        ex = ThreadPoolExecutor(max_workers=min(4, len(urls)))
+        try:
+            futures = {ex.submit(self.session.head, u, timeout=probe_timeout, allow_redirects=True): i
+                       for i, u in enumerate(urls)}
+            results = {}
+            for f in as_completed(futures):
+                try:
+                    results[futures[f]] = f.result()
+                except requests.RequestException:
+                    results[futures[f]] = None
+                for i in range(len(urls)):
+                    if i not in results:
+                        break
+                    r = results[i]
+                    if r is not None and 200 <= r.status_code < 300:
+                        return urls[i], r
+            for i, u in enumerate(urls):
+                if results[i] is not None and results[i].status_code == 405:
+                    return u, None
+            return urls[0], None
+        finally:
+            ex.shutdown(wait=False, cancel_futures=True)
+
+    def _probe_range(self, url: str, head: Optional[requests.Response] = None):
+        """
+        HEAD the URL (or reuse a HEAD response already made for it); return
+        (content_length, headers) if byte ranges are supported and the file is
+        large enough to split, else (None, None).
+        """
+        r = head
+        if r is None:
+            try:
+                r = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            except requests.RequestException:
+                return None, None
+        if not r.ok or r.headers.get("Accept-Ranges", "").lower() != "bytes":
+            return None, None
+        try:
+            size = int(r.headers.get("Content-Length", ""))
+        except ValueError:
+            return None, None
+        if size < RANGE_MIN_SIZE:
+            return None, None
+        return size, dict(r.headers)
+
+    def _download_ranges(self, url: str, fd: int, size: int, parts: int,
+                         headers: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """
+        Download [0, size) as `parts` ranges written in place with os.pwrite.
+        Returns None if the server ignores Range (replies 200 instead of 206).
+        """
+        os.ftruncate(fd, size)
+        step = -(-size // parts)
+        ranges = [(a, min(a + step, size) - 1) for a in range(0, size, step)]
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as ex:
+                for f in [ex.submit(self._fetch_range, url, fd, a, b) for a, b in ranges]:
+                    f.result()
+        except _RangeNotSupported:
+            return None
+        return {"status_code": 206, "ok": True, "headers": headers}
+
+    def _fetch_range(self, url: str, fd: int, start: int, end: int) -> None:
+        pos = start
+        failures = 0
+        while pos <= end:
+            try:
+                with self.session.get(url, headers={"Range": f"bytes={pos}-{end}"},
+                                      stream=True, timeout=self.timeout) as r:
+                    if r.status_code != 206:
+                        raise _RangeNotSupported(r.status_code)
+                    for chunk in r.iter_content(chunk_size=1 << 20):
+                        chunk = chunk[:end + 1 - pos]
+                        os.pwrite(fd, chunk, pos)
+                        pos += len(chunk)
+                        if pos > end:
+                            break
+            except requests.RequestException:
+                # 只重新请求尚未写入的部分
+                failures += 1
+                if failures > RANGE_RETRIES:
+                    raise
+                continue
+            if pos <= end:
+                failures += 1
+                if failures > RANGE_RETRIES:
+                    raise requests.ConnectionError(f"incomplete range {pos}-{end}")
+
+    def _build_response(self, resp: requests.Response, want_raw: bool = False, want_text: bool = True) -> Dict[str, Any]:
+        """
+        Materialize only the body forms that make sense for the Content-Type:
+        JSON bodies are parsed once; binary bodies are kept as raw bytes only when asked.
+        """
         result = {
             "status_code": resp.status_code,
             "ok": resp.ok,
             "headers": dict(resp.headers),
-            "text": resp.text,
+            "text": None,
             "json": None,
-            "raw": resp.content
+            "raw": None
         }
         ct = resp.headers.get("Content-Type", "")
-        if "application/json" in ct or (resp.text and resp.text.strip().startswith("{")):
+        # 未声明 charset 时 resp.text 会对整个 body 做编码探测（chardet），这里直接按 utf-8 解码
+        if resp.encoding is None:
+            resp.encoding = "utf-8"
+        if "application/json" in ct:
             try:
-                result["json"] = resp.json()
-            except Exception:
-                result["json"] = None
-        return result
\ No newline at end of file
+                result["json"] = json_loads(resp.content)
+            except ValueError:
+                # 非法 JSON 时保留文本便于排查
+                result["text"] = resp.text
+        elif ct.startswith("video") or "octet-stream" in ct:
+            if want_raw:
+                result["raw"] = resp.content
+        else:
+            # 只有文本类型才解码为 text
+            if want_text and (not ct or ct.startswith(("text/", "application/xml"))):
+                result["text"] = resp.text
+            if want_raw:
+                result["raw"] = resp.content
+        return result
+
+
+@functools.lru_cache(maxsize=32)
+def get_client(base_url: str, api_key: Optional[str], timeout: int) -> SoraAPIClient:
+    """
+    Shared client per (base_url, api_key, timeout), so consecutive nodes reuse
+    the same session and its keep-alive connections. requests.Session is safe
+    for concurrent requests here because its headers are never mutated after
+    construction.
+    """
+    return SoraAPIClient(base_url, api_key, timeout)